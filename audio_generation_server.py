@@ -10,20 +10,114 @@ import json
 import logging
 import tempfile
 import base64
+import contextlib
+import functools
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from enum import Enum
 from typing import Optional, Dict, Any
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import numpy as np
-import soundfile as sf
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import soxr
 import torch
+from wav_utils import wav_header, float_to_pcm16, write_wav_pcm16
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import miniaudio
+except ImportError:
+    miniaudio = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, much faster for the large base64 payloads."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Unity integration
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Test audio keywords -> (base frequency, frequency step per seed), checked in order
+TEST_FREQUENCY_TABLE = (
+    (('river', 'water'), (200, 50)),  # Low frequency for water
+    (('ocean', 'wave'), (150, 30)),  # Very low frequency for ocean
+    (('bird', 'chirp'), (1000, 200)),  # High frequency for bird
+    (('wind',), (300, 40)),  # Mid-low frequency for wind
+)
+
+# Test audio harmonics as (frequency ratio, amplitude): fundamental, harmonic and sub-harmonic
+TEST_HARMONICS = ((1.0, 0.3), (2.0, 0.1), (0.5, 0.1))
+TEST_HARMONIC_RATIOS = np.array([ratio for ratio, _ in TEST_HARMONICS], dtype=np.float32)
+TEST_HARMONIC_AMPS = np.array([amp for _, amp in TEST_HARMONICS], dtype=np.float32)
+# numexpr treats Python float literals as double, so the constants are bound as float32 names
+TEST_HARMONIC_EXPR = " + ".join(f"a{i} * sin(r{i} * w * t)" for i in range(len(TEST_HARMONICS)))
+TEST_HARMONIC_CONSTANTS = {
+    **{f"r{i}": np.float32(ratio) for i, (ratio, _) in enumerate(TEST_HARMONICS)},
+    **{f"a{i}": np.float32(amp) for i, (_, amp) in enumerate(TEST_HARMONICS)},
+}
+
+# Shared keep-alive session so ElevenLabs calls reuse TCP/TLS connections
+ELEVENLABS_SESSION = requests.Session()
+ELEVENLABS_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
+
+# Number of samples converted to PCM per streamed response chunk
+WAV_STREAM_BLOCK = 65536
+
+def iter_wav_chunks(audio: np.ndarray, sample_rate: int):
+    """Yield a mono float waveform as a 16-bit PCM WAV file, one block at a time."""
+    yield wav_header(len(audio), sample_rate)
+    for start in range(0, len(audio), WAV_STREAM_BLOCK):
+        block = audio[start:start + WAV_STREAM_BLOCK]
+        yield float_to_pcm16(block).tobytes()
+
+def iter_bytes_chunks(data: bytes):
+    """Yield an already-encoded file in bytes slices (WSGI servers reject memoryview chunks)."""
+    for start in range(0, len(data), WAV_STREAM_BLOCK):
+        yield data[start:start + WAV_STREAM_BLOCK]
+
+@functools.lru_cache(maxsize=8)
+def test_timebase(sample_rate: int, duration: float):
+    """Build the time axis and fade envelope for a test tone; bounded so client sample rates can't grow memory."""
+    t = np.linspace(0, duration, int(sample_rate * duration), dtype=np.float32)
+    envelope = np.ones_like(t)
+    fade_len = int(0.1 * sample_rate)
+    envelope[:fade_len] = np.linspace(0, 1, fade_len)
+    envelope[-fade_len:] = np.linspace(1, 0, fade_len)
+    # Shared between requests, so guard against in-place edits
+    t.setflags(write=False)
+    envelope.setflags(write=False)
+    return t, envelope
 
 class AudioProvider(Enum):
     AUDIOLDM2 = "audioldm2"
@@ -33,10 +127,20 @@ class AudioProvider(Enum):
 class AudioGenerationServer:
     def __init__(self):
         self.audioldm2_model = None
+        self.audioldm2_dtype = None
         self.device = None
         self.elevenlabs_api_key = None
         self.default_provider = AudioProvider.AUDIOLDM2
         self.config = self.load_config()
+        self._unity_key_cache = {}  # Unity key file path -> (mtime, decoded ElevenLabs key)
+        self._elevenlabs_cache = OrderedDict()  # (prompt, duration, influence, sample_rate) -> WAV bytes
+        self._elevenlabs_cache_lock = threading.Lock()
+
+        # A single worker owns the pipeline and batches concurrent AudioLDM2 requests
+        self._audioldm2_queue = queue.Queue()
+        self._generator_pool = []  # Reusable torch.Generator per batch slot
+        self._latent_pool = {}  # Latent sample shape -> reusable noise buffer
+        threading.Thread(target=self.audioldm2_batch_worker, daemon=True).start()
 
     def load_config(self):
         """Load configuration from file if it exists."""
@@ -53,13 +157,23 @@ class AudioGenerationServer:
                 "elevenlabs": {
                     "api_key": "",
                     "duration_seconds": 10.0,
-                    "prompt_influence": 0.3
+                    "prompt_influence": 0.3,
+                    "cache_size": 64
                 },
                 "audioldm2": {
                     "model_id": "cvssp/audioldm2",
                     "use_float16": True,
-                    "num_inference_steps": 200,
-                    "audio_length_in_s": 10.0
+                    "compile": True,
+                    "quantize": None,
+                    "autocast": True,
+                    "offload": False,
+                    "num_inference_steps": 40,
+                    "guidance_scale": 2.5,
+                    "audio_length_in_s": 10.0,
+                    "max_batch_size": 4,
+                    "batch_window_s": 0.05,
+                    "batch_grace_s": 0.005,
+                    "request_timeout_s": 300
                 }
             }
             # Save default config
@@ -77,7 +191,7 @@ class AudioGenerationServer:
         logger.info("Initializing AudioLDM2 model...")
 
         try:
-            from diffusers import AudioLDM2Pipeline
+            from diffusers import AudioLDM2Pipeline, DPMSolverMultistepScheduler
 
             # Determine device (GPU if available)
             if torch.cuda.is_available():
@@ -90,19 +204,96 @@ class AudioGenerationServer:
 
             # Load the model
             model_config = self.config.get("audioldm2", {})
-            dtype = torch.float16 if torch.cuda.is_available() and model_config.get("use_float16", True) else torch.float32
+            if torch.cuda.is_available() and model_config.get("use_float16", True):
+                # bfloat16 keeps the float32 exponent range, so it avoids the fp16 NaN issues
+                dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            else:
+                dtype = torch.float32
+            self.audioldm2_dtype = dtype
+
+            if self.device.type == "cuda":
+                # Let any remaining float32 matmuls/convolutions use TF32 tensor cores
+                torch.backends.cuda.matmul.allow_tf32 = True
+                torch.backends.cudnn.allow_tf32 = True
+
+            # low_cpu_mem_usage loads safetensors weights straight into place instead of
+            # materializing a float32 copy first; the fp16 variant halves the download/read size
+            model_id = model_config.get("model_id", "cvssp/audioldm2")
+            load_kwargs = {"torch_dtype": dtype, "use_safetensors": True, "low_cpu_mem_usage": True}
+            variant = "fp16" if dtype == torch.float16 else None
+            try:
+                pipe = AudioLDM2Pipeline.from_pretrained(model_id, variant=variant, **load_kwargs)
+            except (ValueError, OSError) as e:
+                # Only a missing fp16 variant is worth a retry; other errors (OOM, network) propagate
+                if variant != "fp16":
+                    raise
+                logger.warning(f"Failed to load fp16 variant, loading default weights: {e}")
+                pipe = AudioLDM2Pipeline.from_pretrained(model_id, **load_kwargs)
+
+            offload = self.device.type == "cuda" and model_config.get("offload", False)
+            if offload:
+                # Keep weights on the CPU and move each sub-model to the GPU only while it runs
+                pipe.enable_model_cpu_offload()
+            else:
+                pipe.to(self.device)
 
-            self.audioldm2_model = AudioLDM2Pipeline.from_pretrained(
-                model_config.get("model_id", "cvssp/audioldm2"),
-                torch_dtype=dtype,
-                use_safetensors=True
-            ).to(self.device)
+            # DPM-Solver++ reaches the same quality in far fewer steps than the default scheduler
+            pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+                pipe.scheduler.config,
+                algorithm_type="dpmsolver++",
+                use_karras_sigmas=True
+            )
 
+            # VAE slicing decodes batched latents one sample at a time to cap peak memory
+            pipe.enable_vae_slicing()
+
+            # Optional INT8 weight-only quantization of the UNet (requires torchao)
+            if model_config.get("quantize") == "int8":
+                try:
+                    from torchao.quantization import quantize_, int8_weight_only
+                    quantize_(pipe.unet, int8_weight_only())
+                    logger.info("Quantized AudioLDM2 UNet weights to INT8")
+                except ImportError:
+                    logger.warning("torchao not installed - skipping INT8 quantization. Install with: pip install torchao")
+
+            # Compile the UNet once; the compiled module stays alive on the pipeline across requests.
+            # CUDA Graphs need fixed weight addresses, which CPU offload moves on every call
+            if offload and model_config.get("compile", True):
+                logger.info("Skipping torch.compile: not compatible with model CPU offload")
+            elif self.device.type == "cuda" and model_config.get("compile", True):
+                pipe.unet.to(memory_format=torch.channels_last)
+                try:
+                    pipe.unet = torch.compile(
+                        pipe.unet,
+                        mode="reduce-overhead",
+                        fullgraph=False
+                    )
+                    self.warmup_audioldm2(pipe)
+                except Exception as e:
+                    # e.g. no Triton/Inductor on Windows: fall back to the eager UNet
+                    logger.warning(f"torch.compile failed, running the AudioLDM2 UNet eagerly: {e}")
+                    pipe.unet = getattr(pipe.unet, "_orig_mod", pipe.unet)
+
+            # Publish the pipeline only once it is fully configured, so a failure above
+            # leaves audioldm2_model as None and the next request retries initialization
+            self.audioldm2_model = pipe
             logger.info("AudioLDM2 model loaded successfully!")
         except Exception as e:
             logger.error(f"Failed to initialize AudioLDM2: {e}")
             raise
 
+    def warmup_audioldm2(self, pipe):
+        """Run a short dummy generation so the compile cost is paid at startup, not on the first request."""
+        logger.info("Warming up AudioLDM2 (compiling UNet)...")
+        model_config = self.config.get("audioldm2", {})
+        with torch.inference_mode():
+            pipe(
+                "warmup",
+                num_inference_steps=2,
+                audio_length_in_s=model_config.get("audio_length_in_s", 10.0)
+            )
+        logger.info("AudioLDM2 warm-up complete")
+
     def initialize_elevenlabs(self):
         """Initialize Eleven Labs API."""
         elevenlabs_config = self.config.get("elevenlabs", {})
@@ -122,7 +313,6 @@ class AudioGenerationServer:
     def get_unity_api_key(self):
         """Read ElevenLabs API key from Unity's encrypted storage."""
         import platform
-        import base64
 
         unity_key_paths = []
         if platform.system() == 'Darwin':  # macOS
@@ -133,84 +323,255 @@ class AudioGenerationServer:
             unity_key_paths.append(os.path.expanduser('~/.config/unity3d/DefaultCompany/SatieLang/satie_api_keys.json'))
 
         for key_path in unity_key_paths:
-            if os.path.exists(key_path):
+            try:
+                mtime = os.stat(key_path).st_mtime
+            except OSError:
+                continue
+
+            # Only re-read the key file when it has changed on disk
+            cached = self._unity_key_cache.get(key_path)
+            if cached is not None and cached[0] == mtime:
+                api_key = cached[1]
+            else:
                 try:
-                    with open(key_path, 'r') as f:
-                        data = json.load(f)
-                        for key_config in data.get('keys', []):
-                            if key_config.get('provider') == 1:  # ElevenLabs enum value
-                                encrypted_key = key_config.get('key', '')
-                                # Try to decode if it's base64 encoded (simple fallback)
-                                if encrypted_key.startswith('B64:'):
-                                    api_key = base64.b64decode(encrypted_key[4:]).decode('utf-8')
-                                    logger.info("Found ElevenLabs API key from Unity storage (B64)")
-                                    return api_key
-                                else:
-                                    # For now, we can't decrypt the AES encryption without the proper key
-                                    # But Unity should update to use B64 for cross-app compatibility
-                                    logger.warning("Found encrypted ElevenLabs key but cannot decrypt (use B64 encoding in Unity)")
-                                break
+                    api_key = self.read_unity_key_file(key_path)
                 except Exception as e:
                     logger.warning(f"Failed to read Unity API keys: {e}")
+                    continue
+                self._unity_key_cache[key_path] = (mtime, api_key)
 
+            if api_key:
+                return api_key
+
+        return None
+
+    def read_unity_key_file(self, key_path: str) -> Optional[str]:
+        """Parse a Unity API key file and return the decoded ElevenLabs key, if any."""
+        with open(key_path, 'r') as f:
+            data = json.load(f)
+        for key_config in data.get('keys', []):
+            if key_config.get('provider') == 1:  # ElevenLabs enum value
+                encrypted_key = key_config.get('key', '')
+                # Try to decode if it's base64 encoded (simple fallback)
+                if encrypted_key.startswith('B64:'):
+                    api_key = base64.b64decode(encrypted_key[4:]).decode('utf-8')
+                    logger.info("Found ElevenLabs API key from Unity storage (B64)")
+                    return api_key
+                else:
+                    # For now, we can't decrypt the AES encryption without the proper key
+                    # But Unity should update to use B64 for cross-app compatibility
+                    logger.warning("Found encrypted ElevenLabs key but cannot decrypt (use B64 encoding in Unity)")
+                break
         return None
 
     def generate_with_audioldm2(self, prompt: str, seed: int = 0, **kwargs) -> bytes:
         """Generate audio using AudioLDM2."""
-        if self.audioldm2_model is None:
-            self.initialize_audioldm2()
+        return self.generate_with_audioldm2_batch(prompt, [seed], **kwargs)[0]
+
+    def generate_with_audioldm2_batch(self, prompt: str, seeds: list, **kwargs) -> list:
+        """Generate one AudioLDM2 WAV file per seed in a single batched pipeline call."""
+        audios, sample_rate = self.render_audioldm2_batch(prompt, seeds, **kwargs)
+        return [write_wav_pcm16(audio_data, sample_rate) for audio_data in audios]
+
+    def render_audioldm2_batch(self, prompt: str, seeds: list, **kwargs):
+        """Generate one normalized AudioLDM2 waveform per seed, returned with its sample rate.
+
+        Raises ValueError for malformed input, before anything is queued, and
+        concurrent.futures.TimeoutError if the batch worker does not finish within the
+        configured request_timeout_s.
+        """
+        # Requests from different clients share a pipeline call, so bad input must never reach it
+        if not isinstance(prompt, str):
+            raise ValueError("prompt must be a string")
+        if not all(isinstance(seed, int) and not isinstance(seed, bool) for seed in seeds):
+            raise ValueError("seed must be an integer")
+        params = self.audioldm2_params(kwargs)
+        futures = [self.submit_audioldm2(prompt, seed, params) for seed in seeds]
+        sample_rate = kwargs.get("sample_rate", 16000)
 
+        # Resampling only happens after the GPU call, so it is done per request, not per batch
+        deadline = time.monotonic() + self.config.get("audioldm2", {}).get("request_timeout_s", 300)
+        audios = []
+        try:
+            for future in futures:
+                audio_data = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                audios.append(self.resample_audioldm2_output(audio_data, sample_rate))
+        except FutureTimeoutError:
+            # Drop whatever the worker has not started yet
+            for future in futures:
+                future.cancel()
+            raise
+        return audios, sample_rate
+
+    def audioldm2_params(self, kwargs: dict) -> tuple:
+        """Resolve and validate the batching key (num_inference_steps, guidance_scale, audio_length_in_s)."""
         model_config = self.config.get("audioldm2", {})
-        num_inference_steps = kwargs.get("num_inference_steps", model_config.get("num_inference_steps", 200))
+        num_inference_steps = kwargs.get("num_inference_steps", model_config.get("num_inference_steps", 40))
+        guidance_scale = kwargs.get("guidance_scale", model_config.get("guidance_scale", 2.5))
         audio_length_in_s = kwargs.get("audio_length_in_s", model_config.get("audio_length_in_s", 10.0))
-        sample_rate = kwargs.get("sample_rate", 16000)
 
-        logger.info(f"Generating audio with AudioLDM2 - Prompt: '{prompt}', Seed: {seed}")
+        if isinstance(num_inference_steps, bool) or not isinstance(num_inference_steps, int) or num_inference_steps < 1:
+            raise ValueError("num_inference_steps must be a positive integer")
+        for name, value in (("guidance_scale", guidance_scale), ("audio_length_in_s", audio_length_in_s)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{name} must be a number")
+        if audio_length_in_s <= 0:
+            raise ValueError("audio_length_in_s must be positive")
+        return (num_inference_steps, float(guidance_scale), float(audio_length_in_s))
+
+    def submit_audioldm2(self, prompt: str, seed: int, params: tuple) -> Future:
+        """Queue a single AudioLDM2 generation for the batching worker."""
+        future = Future()
+        self._audioldm2_queue.put((prompt, seed, params, future))
+        return future
+
+    def audioldm2_batch_worker(self):
+        """Collect queued requests with matching params into batches and run them on the pipeline."""
+        model_config = self.config.get("audioldm2", {})
+        max_batch = model_config.get("max_batch_size", 4)
+        window = model_config.get("batch_window_s", 0.05)
+        grace = model_config.get("batch_grace_s", 0.005)
+        deferred = []  # Requests whose params did not match the batch they arrived during
+
+        while True:
+            batch = [deferred.pop(0) if deferred else self._audioldm2_queue.get()]
+            params = batch[0][2]
+
+            # Pick up deferred requests that fit this batch first
+            for item in [item for item in deferred if item[2] == params][:max_batch - 1]:
+                deferred.remove(item)
+                batch.append(item)
+
+            # Then wait briefly for more requests to arrive; stop as soon as nothing new
+            # shows up within the grace period so a lone request is not held for the full window
+            deadline = time.monotonic() + window
+            while len(batch) < max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._audioldm2_queue.get(timeout=min(remaining, grace))
+                except queue.Empty:
+                    break
+                if item[2] == params:
+                    batch.append(item)
+                else:
+                    deferred.append(item)
+
+            # Skip requests whose caller already timed out and cancelled them
+            batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                audios = self.run_audioldm2([item[0] for item in batch], [item[1] for item in batch], params)
+                for item, audio_data in zip(batch, audios):
+                    item[3].set_result(audio_data)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.error(f"AudioLDM2 generation failed: {e}")
+                    batch[0][3].set_exception(e)
+                    continue
+
+                # Rerun each request alone so the error only reaches the request that caused it
+                logger.error(f"AudioLDM2 batch generation failed, retrying {len(batch)} requests individually: {e}")
+                for item in batch:
+                    try:
+                        item[3].set_result(self.run_audioldm2([item[0]], [item[1]], params)[0])
+                    except Exception as item_error:
+                        item[3].set_exception(item_error)
+
+    def audioldm2_latents(self, generators: list, audio_length_in_s: float) -> torch.Tensor:
+        """Fill a pooled latent buffer with initial noise, matching the pipeline's own sampling."""
+        pipe = self.audioldm2_model
+        vocoder_upsample_factor = np.prod(pipe.vocoder.config.upsample_rates) / pipe.vocoder.config.sampling_rate
+        height = int(audio_length_in_s / vocoder_upsample_factor)
+        if height % pipe.vae_scale_factor != 0:
+            height = int(np.ceil(height / pipe.vae_scale_factor)) * pipe.vae_scale_factor
+        sample_shape = (
+            pipe.unet.config.in_channels,
+            height // pipe.vae_scale_factor,
+            pipe.vocoder.config.model_in_dim // pipe.vae_scale_factor
+        )
+
+        # One buffer per latent shape, grown to the largest batch seen so far
+        latent_buf = self._latent_pool.get(sample_shape)
+        if latent_buf is None or latent_buf.shape[0] < len(generators):
+            latent_buf = torch.empty((len(generators),) + sample_shape, device=self.device, dtype=pipe.unet.dtype)
+            self._latent_pool[sample_shape] = latent_buf
+
+        latents = latent_buf[:len(generators)]
+        for i, generator in enumerate(generators):
+            torch.randn(sample_shape, generator=generator, device=self.device, dtype=latents.dtype, out=latents[i])
+        return latents
+
+    def run_audioldm2(self, prompts: list, seeds: list, params: tuple) -> np.ndarray:
+        """Run one batched pipeline call and return normalized 16kHz waveforms."""
+        if self.audioldm2_model is None:
+            self.initialize_audioldm2()
+
+        num_inference_steps, guidance_scale, audio_length_in_s = params
+
+        logger.info(f"Generating audio with AudioLDM2 - Prompts: {prompts}, Seeds: {seeds}")
 
-        # Set seed for reproducibility
-        generator = torch.Generator(device=self.device).manual_seed(seed)
+        # One generator per sample keeps each variation reproducible by its own seed;
+        # generators are pooled per batch slot and simply re-seeded
+        while len(self._generator_pool) < len(seeds):
+            self._generator_pool.append(torch.Generator(device=self.device))
+        generators = [generator.manual_seed(seed) for generator, seed in zip(self._generator_pool, seeds)]
 
-        # Generate audio
-        with torch.no_grad():
+        # Generate audio; autocast keeps the ops that would otherwise upcast to float32 in half precision
+        model_config = self.config.get("audioldm2", {})
+        use_autocast = (
+            self.device.type == "cuda"
+            and self.audioldm2_dtype != torch.float32
+            and model_config.get("autocast", True)
+        )
+        autocast = (
+            torch.autocast(device_type=self.device.type, dtype=self.audioldm2_dtype)
+            if use_autocast else contextlib.nullcontext()
+        )
+        with torch.inference_mode(), autocast:
+            latents = self.audioldm2_latents(generators, audio_length_in_s)
             output = self.audioldm2_model(
-                prompt,
+                prompts,
                 num_inference_steps=num_inference_steps,
                 audio_length_in_s=audio_length_in_s,
-                generator=generator
+                guidance_scale=guidance_scale,
+                generator=generators,
+                latents=latents,
+                output_type="pt"
             )
 
-        # Get the audio array
-        audio_array = output.audios[0]
-
+        # Normalize every waveform in the batch at once to prevent clipping, on whatever
+        # device the pipeline returned, then convert to numpy a single time
+        audios = output.audios.float()
+        max_vals = audios.abs().amax(dim=-1, keepdim=True)
+        if bool((max_vals > 0.95).any()):
+            # Only waveforms that would clip are scaled; the rest are multiplied by 1
+            audios = audios * (0.95 / max_vals.clamp_min(0.95))
+        return audios.cpu().numpy()
+
+    def resample_audioldm2_output(self, audio_array: np.ndarray, sample_rate: int) -> np.ndarray:
+        """Flatten a single AudioLDM2 waveform and resample it to the requested rate."""
         # Ensure audio is in the correct shape
         if audio_array.ndim == 1:
             audio_data = audio_array
         else:
             audio_data = audio_array.squeeze()
 
-        # Normalize audio to prevent clipping
-        max_val = np.abs(audio_data).max()
-        if max_val > 0:
-            audio_data = audio_data / max_val * 0.95
-
         # Convert to the requested sample rate if needed
         if sample_rate != 16000:
-            import librosa
-            audio_data = librosa.resample(
-                audio_data,
-                orig_sr=16000,
-                target_sr=sample_rate
-            )
+            audio_data = soxr.resample(audio_data, 16000, sample_rate, quality="HQ")
 
-        # Create WAV file in memory
-        wav_buffer = io.BytesIO()
-        sf.write(wav_buffer, audio_data, sample_rate, format='WAV')
-        wav_buffer.seek(0)
-
-        return wav_buffer.getvalue()
+        return audio_data
 
     def generate_with_elevenlabs(self, prompt: str, api_key_override: str = None, **kwargs) -> bytes:
         """Generate sound effects using Eleven Labs Sound Generation API."""
+        return self.generate_with_elevenlabs_cached(prompt, api_key_override, **kwargs)[0]
+
+    def generate_with_elevenlabs_cached(self, prompt: str, api_key_override: str = None, **kwargs):
+        """Generate an Eleven Labs sound effect, returning (wav_bytes, cache_hit)."""
         # Use override key if provided, otherwise use configured key
         api_key = api_key_override or self.elevenlabs_api_key
 
@@ -220,11 +581,31 @@ class AudioGenerationServer:
             api_key = self.elevenlabs_api_key
 
         try:
-            import requests
-
             elevenlabs_config = self.config.get("elevenlabs", {})
-            duration_seconds = kwargs.get("duration_seconds", elevenlabs_config.get("duration_seconds", 10.0))
-            prompt_influence = kwargs.get("prompt_influence", elevenlabs_config.get("prompt_influence", 0.3))
+            duration_seconds = kwargs.get("duration_seconds")
+            if duration_seconds is None:
+                duration_seconds = elevenlabs_config.get("duration_seconds", 10.0)
+            prompt_influence = kwargs.get("prompt_influence")
+            if prompt_influence is None:
+                prompt_influence = elevenlabs_config.get("prompt_influence", 0.3)
+            sample_rate = kwargs.get("sample_rate", 44100)
+            try:
+                duration_seconds = float(duration_seconds)
+                prompt_influence = float(prompt_influence)
+            except (TypeError, ValueError):
+                raise ValueError("duration_seconds and prompt_influence must be numbers")
+
+            # Repeat prompts in a session are served from the LRU cache of converted WAVs;
+            # the key hash keeps one account's results from being served to another
+            key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+            cache_key = (key_hash, prompt, round(duration_seconds, 2), round(prompt_influence, 2), sample_rate)
+            with self._elevenlabs_cache_lock:
+                wav_data = self._elevenlabs_cache.get(cache_key)
+                if wav_data is not None:
+                    self._elevenlabs_cache.move_to_end(cache_key)
+            if wav_data is not None:
+                logger.info(f"Eleven Labs cache hit - Prompt: '{prompt}'")
+                return wav_data, True
 
             logger.info(f"Generating sound effect with Eleven Labs - Prompt: '{prompt}'")
 
@@ -243,7 +624,7 @@ class AudioGenerationServer:
                 "prompt_influence": prompt_influence
             }
 
-            response = requests.post(url, json=data, headers=headers)
+            response = ELEVENLABS_SESSION.post(url, json=data, headers=headers, timeout=(3.05, 30))
 
             if response.status_code != 200:
                 error_msg = f"Eleven Labs API error: {response.status_code} - {response.text}"
@@ -256,83 +637,105 @@ class AudioGenerationServer:
             if not mp3_data or len(mp3_data) == 0:
                 raise Exception("Eleven Labs returned empty audio data")
 
-            # Use pydub to convert MP3 to WAV
+            logger.info(f"Converting MP3 to WAV (received {len(mp3_data)} bytes)")
             try:
-                from pydub import AudioSegment
-                logger.info(f"Converting MP3 to WAV (received {len(mp3_data)} bytes)")
-                audio = AudioSegment.from_mp3(io.BytesIO(mp3_data))
-
-                # Set to the requested sample rate
-                sample_rate = kwargs.get("sample_rate", 44100)
-                audio = audio.set_frame_rate(sample_rate)
-
-                # Export as WAV
-                wav_buffer = io.BytesIO()
-                audio.export(wav_buffer, format="wav", parameters=["-ar", str(sample_rate)])
-                wav_buffer.seek(0)
-
-                wav_data = wav_buffer.getvalue()
-                logger.info(f"Successfully converted to WAV ({len(wav_data)} bytes, {sample_rate}Hz)")
-                return wav_data
-            except ImportError as e:
-                error_msg = "pydub not installed - cannot convert Eleven Labs MP3 to WAV. Install with: pip install pydub"
-                logger.error(error_msg)
-                raise Exception(error_msg)
+                wav_data = self.convert_mp3_to_wav(mp3_data, sample_rate)
             except Exception as e:
                 error_msg = f"Failed to convert MP3 to WAV: {str(e)}"
                 logger.error(error_msg)
                 raise Exception(error_msg)
 
+            logger.info(f"Successfully converted to WAV ({len(wav_data)} bytes, {sample_rate}Hz)")
+
+            with self._elevenlabs_cache_lock:
+                self._elevenlabs_cache[cache_key] = wav_data
+                while len(self._elevenlabs_cache) > elevenlabs_config.get("cache_size", 64):
+                    self._elevenlabs_cache.popitem(last=False)
+            return wav_data, False
+
         except Exception as e:
             logger.error(f"Eleven Labs sound generation failed: {e}")
             raise
 
+    def convert_mp3_to_wav(self, mp3_data: bytes, sample_rate: int) -> bytes:
+        """Decode MP3 in-process with miniaudio, falling back to pydub/ffmpeg."""
+        if miniaudio is not None:
+            decoded = miniaudio.mp3_read_f32(mp3_data)
+            pcm = np.frombuffer(decoded.samples, dtype=np.float32).reshape(-1, decoded.nchannels)
+            if decoded.sample_rate != sample_rate:
+                pcm = soxr.resample(pcm, decoded.sample_rate, sample_rate, quality="HQ")
+
+            return write_wav_pcm16(pcm, sample_rate)
+
+        # Use pydub to convert MP3 to WAV (spawns ffmpeg)
+        try:
+            from pydub import AudioSegment
+        except ImportError:
+            raise Exception("No MP3 decoder installed - cannot convert Eleven Labs MP3 to WAV. Install with: pip install miniaudio")
+
+        audio = AudioSegment.from_mp3(io.BytesIO(mp3_data))
+
+        # Set to the requested sample rate, 16-bit PCM like every other WAV path
+        audio = audio.set_frame_rate(sample_rate).set_sample_width(2)
+
+        # Export as WAV
+        wav_buffer = io.BytesIO()
+        audio.export(wav_buffer, format="wav", parameters=["-ar", str(sample_rate)])
+        return wav_buffer.getvalue()
+
+    def get_test_timebase(self, sample_rate: int, duration: float):
+        """Return the cached time axis and fade envelope for a test tone."""
+        return test_timebase(sample_rate, duration)
+
     def generate_test_audio(self, prompt: str, seed: int = 0, **kwargs) -> bytes:
         """Generate simple test audio (sine wave)."""
+        audio, sample_rate = self.render_test_audio(prompt, seed, **kwargs)
+        return write_wav_pcm16(audio, sample_rate)
+
+    def render_test_audio(self, prompt: str, seed: int = 0, **kwargs):
+        """Synthesize the test waveform, returned with its sample rate."""
         sample_rate = kwargs.get("sample_rate", 44100)
 
         logger.info(f"Generating test audio for: '{prompt}' with seed: {seed}")
 
         # Generate different frequencies based on prompt
-        if 'river' in prompt.lower() or 'water' in prompt.lower():
-            frequency = 200 + seed * 50  # Low frequency for water
-        elif 'ocean' in prompt.lower() or 'wave' in prompt.lower():
-            frequency = 150 + seed * 30  # Very low frequency for ocean
-        elif 'bird' in prompt.lower() or 'chirp' in prompt.lower():
-            frequency = 1000 + seed * 200  # High frequency for bird
-        elif 'wind' in prompt.lower():
-            frequency = 300 + seed * 40  # Mid-low frequency for wind
+        prompt_lower = prompt.lower()
+        for keywords, (base_freq, seed_step) in TEST_FREQUENCY_TABLE:
+            if any(keyword in prompt_lower for keyword in keywords):
+                break
         else:
-            frequency = 440 + seed * 100  # Default A note
+            base_freq, seed_step = 440, 100  # Default A note
+        frequency = base_freq + seed * seed_step
 
         # Generate 3 seconds of sine wave with harmonics
         duration = 3.0
-        t = np.linspace(0, duration, int(sample_rate * duration))
-
-        # Create a more interesting sound with multiple harmonics
-        audio = np.sin(2 * np.pi * frequency * t) * 0.3
-        audio += np.sin(2 * np.pi * frequency * 2 * t) * 0.1  # Harmonic
-        audio += np.sin(2 * np.pi * frequency * 0.5 * t) * 0.1  # Sub-harmonic
+        t, envelope = self.get_test_timebase(sample_rate, duration)
+
+        # Create a more interesting sound with multiple harmonics in a single pass
+        if numexpr is not None:
+            # numexpr fuses all harmonics and the weighted sum into one blocked loop over t
+            audio = numexpr.evaluate(
+                TEST_HARMONIC_EXPR,
+                local_dict={"w": np.float32(2 * np.pi * frequency), "t": t, **TEST_HARMONIC_CONSTANTS}
+            )
+        else:
+            freqs = np.float32(2 * np.pi * frequency) * TEST_HARMONIC_RATIOS
+            audio = TEST_HARMONIC_AMPS @ np.sin(freqs[:, None] * t[None, :])
 
-        # Add some noise for texture
-        audio += np.random.normal(0, 0.01, len(t))
+        # Add some noise for texture, seeded per request (PCG64) rather than the global RNG;
+        # PCG64 rejects negative and float seeds, so fold JSON seeds into the uint32 range
+        rng = np.random.Generator(np.random.PCG64(int(seed) & 0xFFFFFFFF))
+        noise = rng.standard_normal(len(t), dtype=np.float32)
+        noise *= 0.01
+        audio += noise
 
         # Apply envelope (fade in/out)
-        envelope = np.ones_like(t)
-        fade_len = int(0.1 * sample_rate)
-        envelope[:fade_len] = np.linspace(0, 1, fade_len)
-        envelope[-fade_len:] = np.linspace(1, 0, fade_len)
         audio *= envelope
 
         # Normalize
-        audio = audio / np.max(np.abs(audio)) * 0.9
+        audio *= 0.9 / np.max(np.abs(audio))
 
-        # Create WAV file in memory
-        wav_buffer = io.BytesIO()
-        sf.write(wav_buffer, audio, sample_rate, format='WAV')
-        wav_buffer.seek(0)
-
-        return wav_buffer.getvalue()
+        return audio, sample_rate
 
 # Create server instance
 server = AudioGenerationServer()
@@ -374,28 +777,46 @@ def generate_audio():
         if not prompt:
             return jsonify({"error": "No prompt provided"}), 400
 
+        # Remove prompt and seed from data dict to avoid duplicate arguments
+        generation_params = {k: v for k, v in data.items() if k not in ('prompt', 'seed')}
+
         # Generate audio based on provider
         if provider == AudioProvider.ELEVENLABS.value:
             # Get API key from header if provided
             api_key_from_header = request.headers.get('X-ElevenLabs-Key')
-            # Remove prompt from data dict to avoid duplicate argument
-            generation_params = {k: v for k, v in data.items() if k != 'prompt'}
-            audio_data = server.generate_with_elevenlabs(prompt, api_key_override=api_key_from_header, **generation_params)
-        elif provider == AudioProvider.TEST.value:
-            audio_data = server.generate_test_audio(prompt, seed, **data)
-        else:  # Default to AudioLDM2
-            audio_data = server.generate_with_audioldm2(prompt, seed, **data)
+            audio_data, cache_hit = server.generate_with_elevenlabs_cached(prompt, api_key_override=api_key_from_header, **generation_params)
+            content_length = len(audio_data)
+            wav_stream = iter_bytes_chunks(audio_data)
+            extra_headers = {'X-Cache': 'HIT' if cache_hit else 'MISS'}
+        else:
+            if provider == AudioProvider.TEST.value:
+                audio, sample_rate = server.render_test_audio(prompt, seed, **generation_params)
+            else:  # Default to AudioLDM2
+                audios, sample_rate = server.render_audioldm2_batch(prompt, [seed], **generation_params)
+                audio = audios[0]
+            content_length = 44 + len(audio) * 2
+            wav_stream = iter_wav_chunks(audio, sample_rate)
+            extra_headers = {}
 
         logger.info(f"Audio generated successfully using {provider}")
 
-        # Return the WAV file
-        return send_file(
-            io.BytesIO(audio_data),
+        # Stream the WAV file; PCM conversion happens block by block as it is sent
+        return Response(
+            stream_with_context(wav_stream),
             mimetype='audio/wav',
-            as_attachment=True,
-            download_name=f'generated_{provider}_{seed}.wav'
+            headers={
+                'Content-Disposition': f'attachment; filename=generated_{provider}_{seed}.wav',
+                'Content-Length': str(content_length),
+                **extra_headers
+            }
         )
 
+    except FutureTimeoutError:
+        logger.error("AudioLDM2 generation timed out")
+        return jsonify({"error": "AudioLDM2 generation timed out"}), 504
+    except ValueError as e:
+        logger.error(f"Invalid audio generation request: {str(e)}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error generating audio: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -417,27 +838,34 @@ def generate_multiple_audio():
 
         audio_files = []
 
-        for i in range(num_options):
-            # Use different seed for each variation
-            data['seed'] = i
-
-            # Generate audio based on provider
-            if provider == AudioProvider.ELEVENLABS.value:
-                # For Eleven Labs, vary prompt influence for different variations
-                data['prompt_influence'] = min(1.0, data.get('prompt_influence', 0.3) + (i * 0.1))
-                # Remove prompt from data dict to avoid duplicate argument
-                generation_params = {k: v for k, v in data.items() if k != 'prompt'}
-                audio_data = server.generate_with_elevenlabs(prompt, **generation_params)
-            elif provider == AudioProvider.TEST.value:
-                audio_data = server.generate_test_audio(prompt, i, **data)
-            else:  # Default to AudioLDM2
-                audio_data = server.generate_with_audioldm2(prompt, i, **data)
-
-            # Encode as base64 for JSON response
-            audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-            audio_files.append(audio_base64)
-
-            logger.info(f"Generated option {i+1}/{num_options}")
+        if provider in (AudioProvider.ELEVENLABS.value, AudioProvider.TEST.value):
+            for i in range(num_options):
+                # Use different seed for each variation
+                data['seed'] = i
+
+                # Generate audio based on provider
+                if provider == AudioProvider.ELEVENLABS.value:
+                    # For Eleven Labs, vary prompt influence for different variations
+                    data['prompt_influence'] = min(1.0, data.get('prompt_influence', 0.3) + (i * 0.1))
+                    # Remove prompt from data dict to avoid duplicate argument
+                    generation_params = {k: v for k, v in data.items() if k != 'prompt'}
+                    audio_data = server.generate_with_elevenlabs(prompt, **generation_params)
+                else:
+                    audio_data = server.generate_test_audio(prompt, i, **data)
+
+                # Encode as base64 for JSON response
+                audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+                audio_files.append(audio_base64)
+
+                logger.info(f"Generated option {i+1}/{num_options}")
+        else:  # Default to AudioLDM2, all variations in one batched pipeline call
+            # Remove prompt and seed from data dict to avoid duplicate arguments
+            generation_params = {k: v for k, v in data.items() if k not in ('prompt', 'seed')}
+            batch = server.generate_with_audioldm2_batch(prompt, list(range(num_options)), **generation_params)
+            for i, audio_data in enumerate(batch):
+                # Encode as base64 for JSON response
+                audio_files.append(base64.b64encode(audio_data).decode('utf-8'))
+                logger.info(f"Generated option {i+1}/{num_options}")
 
         logger.info(f"All {num_options} audio options generated successfully")
 
@@ -448,6 +876,12 @@ def generate_multiple_audio():
             "sample_rate": data.get('sample_rate', 44100)
         })
 
+    except FutureTimeoutError:
+        logger.error("AudioLDM2 generation timed out")
+        return jsonify({"error": "AudioLDM2 generation timed out"}), 504
+    except ValueError as e:
+        logger.error(f"Invalid audio generation request: {str(e)}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error generating multiple audio: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -494,4 +928,5 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     logger.info(f"Starting Multi-Provider Audio Generation Server on port {port}")
     logger.info("Configure providers in audio_config.json")
+    logger.info("For concurrent clients run: gunicorn -c gunicorn_conf.py audio_generation_server:app")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -6,17 +6,32 @@ Supports AudioLDM2 and ElevenLabs for generating audio from text prompts.
 
 import os
 import io
+import json
 import logging
 import base64
-from flask import Flask, request, jsonify, send_file
+import functools
+import platform
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import numpy as np
 import soundfile as sf
+import soxr
+import torch
+from diffusers import AudioLDM2Pipeline, DPMSolverMultistepScheduler
+from wav_utils import wav_header, normalize_and_quantize
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    from elevenlabs.client import ElevenLabs
+except ImportError:
+    ElevenLabs = None
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Unity integration
 
@@ -24,6 +39,86 @@ CORS(app)  # Enable CORS for Unity integration
 audioldm2_model = None
 device = None
 
+# Set AUDIOLDM2_COMPILE=0 to skip torch.compile on CUDA hosts
+AUDIOLDM2_COMPILE = os.environ.get('AUDIOLDM2_COMPILE', '1').lower() not in ('0', 'false', 'no')
+
+# Denoising steps when the request does not specify any (tuned for DPM-Solver++)
+DEFAULT_INFERENCE_STEPS = 25
+
+# Set once float16 fails on MPS; the pipeline is then moved to float32 for good
+_mps_fp16_bad = False
+
+# Text-encoder outputs per prompt (LRU), reused across seeds and repeated requests
+PROMPT_EMBED_CACHE_SIZE = 64
+_prompt_embed_cache = OrderedDict()
+_prompt_embed_lock = threading.Lock()
+
+# The pipeline is not safe to call from several threads at once; only GPU work holds this lock,
+# so resampling, encoding and ElevenLabs requests still run concurrently
+_gpu_lock = threading.Lock()
+_audioldm2_init_failed_at = None  # time.monotonic() of the last failed load, for retry backoff
+AUDIOLDM2_INIT_RETRY_SECONDS = 60
+
+# Page-locked host buffers for decoded CUDA waveforms, one per request thread, grown on demand
+_pinned_out = threading.local()
+
+# Unity's API key storage for this OS (None on unsupported platforms); the platform never changes at runtime
+UNITY_KEY_PATH = {
+    'Darwin': '~/Library/Application Support/DefaultCompany/SatieLang/satie_api_keys.json',
+    'Windows': '~/AppData/LocalLow/DefaultCompany/SatieLang/satie_api_keys.json',
+    'Linux': '~/.config/unity3d/DefaultCompany/SatieLang/satie_api_keys.json'
+}.get(platform.system())
+UNITY_KEY_PATH = os.path.expanduser(UNITY_KEY_PATH) if UNITY_KEY_PATH else None
+
+# Request limits checked before any model work
+VALID_PROVIDERS = {'audioldm2', 'elevenlabs', 'test'}
+MAX_INFERENCE_STEPS = 500
+AUDIO_LENGTH_RANGE = (0.5, 60.0)
+SAMPLE_RATE_RANGE = (8000, 192000)
+MAX_NUM_OPTIONS = 16
+
+# Frames per chunk when streaming a WAV response
+WAV_STREAM_BLOCK = 65536
+
+def iter_wav_chunks(pcm, sample_rate):
+    """Yield 16-bit PCM of shape (frames,) or (frames, channels) as a WAV file, one block at a time."""
+    channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+    yield wav_header(len(pcm), sample_rate, channels)
+    for start in range(0, len(pcm), WAV_STREAM_BLOCK):
+        yield pcm[start:start + WAV_STREAM_BLOCK].tobytes()
+
+# One sine cycle for the test tone, read back by phase index instead of calling np.sin per sample
+SINE_LUT_SIZE = 4096
+SINE_LUT = np.sin(np.linspace(0, 2 * np.pi, SINE_LUT_SIZE, endpoint=False)).astype(np.float32)
+
+# Looping crossfade ramps, keyed by fade length (which follows the client's sample_rate); bounded
+@functools.lru_cache(maxsize=8)
+def get_fades(n):
+    """Return cached float32 fade-in/fade-out ramps of length n."""
+    fade_in = np.linspace(0, 1, n, dtype=np.float32)
+    fade_out = 1.0 - fade_in
+    fade_in.setflags(write=False)
+    fade_out.setflags(write=False)
+    return fade_in, fade_out
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_generation_params(seed, sample_rate, num_inference_steps, audio_length_in_s):
+    """Return an error message for out-of-range generation parameters, or None if they are valid."""
+    if not _is_int(seed) or not -2**31 <= seed < 2**32:
+        return "seed must be an integer in [-2^31, 2^32)"
+    if not _is_int(sample_rate) or not SAMPLE_RATE_RANGE[0] <= sample_rate <= SAMPLE_RATE_RANGE[1]:
+        return f"sample_rate must be an integer in [{SAMPLE_RATE_RANGE[0]}, {SAMPLE_RATE_RANGE[1]}]"
+    if not _is_int(num_inference_steps) or not 1 <= num_inference_steps <= MAX_INFERENCE_STEPS:
+        return f"num_inference_steps must be an integer in [1, {MAX_INFERENCE_STEPS}]"
+    if not _is_number(audio_length_in_s) or not AUDIO_LENGTH_RANGE[0] <= audio_length_in_s <= AUDIO_LENGTH_RANGE[1]:
+        return f"audio_length_in_s must be in [{AUDIO_LENGTH_RANGE[0]}, {AUDIO_LENGTH_RANGE[1]}]"
+    return None
+
 def initialize_audioldm2():
     """Initialize the AudioLDM2 model."""
     global audioldm2_model, device
@@ -41,8 +136,8 @@ def initialize_audioldm2():
 
     # Load the model with specific configuration to avoid compatibility issues
     try:
-        # Use float16 for CUDA, float32 for MPS and CPU (MPS doesn't support float16 well)
-        dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+        # Use float16 on GPUs (CUDA and MPS), float32 on CPU
+        dtype = torch.float16 if device.type in ("cuda", "mps") else torch.float32
         audioldm2_model = AudioLDM2Pipeline.from_pretrained(
             "cvssp/audioldm2",
             torch_dtype=dtype,
@@ -51,98 +146,274 @@ def initialize_audioldm2():
     except Exception as e:
         logger.warning(f"Failed to load with safetensors: {e}")
         # Fallback to regular loading
-        dtype = torch.float16 if torch.cuda.is_available() else torch.float32
         audioldm2_model = AudioLDM2Pipeline.from_pretrained(
             "cvssp/audioldm2",
             torch_dtype=dtype
         ).to(device)
 
+    # DPM-Solver++ converges in ~20-25 steps instead of the default scheduler's 200
+    audioldm2_model.scheduler = DPMSolverMultistepScheduler.from_config(
+        audioldm2_model.scheduler.config,
+        algorithm_type="dpmsolver++",
+        use_karras_sigmas=True
+    )
+
+    # Inference only: keep autograd away from the weights even outside inference_mode()
+    for module in (audioldm2_model.unet, audioldm2_model.vae, audioldm2_model.vocoder,
+                   audioldm2_model.text_encoder, audioldm2_model.text_encoder_2,
+                   audioldm2_model.projection_model, audioldm2_model.language_model):
+        module.requires_grad_(False)
+
+    if device.type == "cuda" and AUDIOLDM2_COMPILE:
+        # Inductor fuses the UNet and vocoder kernels. CUDA Graphs (mode="reduce-overhead") are
+        # deliberately not used: their state is per thread, and requests run on whichever
+        # server thread picked them up, so every thread would re-record its own graphs
+        try:
+            audioldm2_model.unet = torch.compile(audioldm2_model.unet, fullgraph=False)
+            audioldm2_model.vocoder = torch.compile(audioldm2_model.vocoder, fullgraph=False)
+            _warmup_compile()
+        except Exception as e:
+            # e.g. no Triton/Inductor on Windows: fall back to the eager modules
+            logger.warning(f"torch.compile failed, running AudioLDM2 eagerly: {e}")
+            audioldm2_model.unet = getattr(audioldm2_model.unet, "_orig_mod", audioldm2_model.unet)
+            audioldm2_model.vocoder = getattr(audioldm2_model.vocoder, "_orig_mod", audioldm2_model.vocoder)
+
     logger.info("AudioLDM2 model loaded successfully!")
     return True
 
+def ensure_audioldm2():
+    """Load AudioLDM2 on first use when the server runs under a WSGI server instead of __main__.
+
+    A failed load is retried on a later request once AUDIOLDM2_INIT_RETRY_SECONDS have passed.
+    """
+    global audioldm2_model, _audioldm2_init_failed_at
+
+    def can_try():
+        return audioldm2_model is None and (
+            _audioldm2_init_failed_at is None
+            or time.monotonic() - _audioldm2_init_failed_at >= AUDIOLDM2_INIT_RETRY_SECONDS
+        )
+
+    if can_try():
+        with _gpu_lock:
+            if can_try():
+                try:
+                    initialize_audioldm2()
+                    _audioldm2_init_failed_at = None
+                except Exception as e:
+                    logger.warning(f"AudioLDM2 initialization failed, retrying in {AUDIOLDM2_INIT_RETRY_SECONDS}s: {e}")
+                    audioldm2_model = None
+                    _audioldm2_init_failed_at = time.monotonic()
+    return audioldm2_model is not None
+
+def _warmup_compile(audio_length_in_s=10.0, num_warmup=2):
+    """Trigger compilation at the default latent shape before the first request."""
+
+    logger.info("Warming up AudioLDM2 (compiling UNet and vocoder)...")
+    with torch.inference_mode():
+        for _ in range(num_warmup):
+            audioldm2_model("warmup", num_inference_steps=3, audio_length_in_s=audio_length_in_s)
+    logger.info("AudioLDM2 warm-up complete")
+
+def _has_non_finite(value):
+    """True if any floating tensor/array in a model output contains NaN or inf."""
+    if torch.is_tensor(value):
+        return value.is_floating_point() and not bool(torch.isfinite(value).all())
+    if isinstance(value, np.ndarray):
+        return np.issubdtype(value.dtype, np.floating) and not np.isfinite(value).all()
+    if isinstance(value, (tuple, list)):
+        return any(_has_non_finite(item) for item in value)
+    if hasattr(value, "audios"):
+        return _has_non_finite(value.audios)
+    return False
+
+def _call_with_fp32_fallback(call, *args, **kwargs):
+    """Run a model call, redoing it in float32 if float16 fails on MPS.
+
+    MPS float16 failures either raise or silently produce NaN/inf, so both count. The switch is
+    permanent: the pipeline is moved to float32 and cached (float16) prompt embeddings are dropped.
+    Callers must hold _gpu_lock.
+    """
+    global _mps_fp16_bad
+
+    fp16_active = device.type == "mps" and not _mps_fp16_bad
+    try:
+        result = call(*args, **kwargs)
+        if not (fp16_active and _has_non_finite(result)):
+            return result
+        reason = "non-finite output"
+    except RuntimeError as e:
+        message = str(e).lower()
+        if not fp16_active or not ("float16" in message or "half" in message):
+            raise
+        reason = str(e)
+
+    logger.warning(f"float16 failed on MPS ({reason}), switching to float32")
+    _mps_fp16_bad = True
+    audioldm2_model.to(dtype=torch.float32)
+    with _prompt_embed_lock:
+        _prompt_embed_cache.clear()
+    kwargs = {
+        name: value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+        for name, value in kwargs.items()
+    }
+    return call(*args, **kwargs)
+
+def run_audioldm2(*args, **kwargs):
+    """Call the AudioLDM2 pipeline under float16 autocast, falling back to float32 if MPS rejects it."""
+
+    def call(*args, **kwargs):
+        # MPS autocast only exists in newer PyTorch releases
+        mps_autocast = getattr(torch.amp, "is_autocast_available", lambda device_type: False)("mps")
+        use_autocast = device.type == "cuda" or (device.type == "mps" and mps_autocast and not _mps_fp16_bad)
+        with torch.inference_mode(), torch.autocast(
+            device_type=device.type if use_autocast else "cpu",
+            dtype=torch.float16,
+            enabled=use_autocast
+        ):
+            return audioldm2_model(*args, **kwargs)
+
+    with _gpu_lock:
+        return _call_with_fp32_fallback(call, *args, **kwargs)
+
+def decode_audioldm2_latents(latents, audio_length_in_s):
+    """Decode CUDA latents to a waveform and copy it into this thread's pinned host buffer.
+
+    Returns a float32 view of the buffer that is valid until the thread's next call.
+    """
+    with _gpu_lock, torch.inference_mode():
+        mel_spectrogram = audioldm2_model.vae.decode(latents / audioldm2_model.vae.config.scaling_factor).sample
+        if mel_spectrogram.dim() == 4:
+            mel_spectrogram = mel_spectrogram.squeeze(1)
+        waveform = audioldm2_model.vocoder(mel_spectrogram)[0]
+        waveform = waveform[:int(audio_length_in_s * audioldm2_model.vocoder.config.sampling_rate)]
+
+        buffer = getattr(_pinned_out, "buffer", None)
+        if buffer is None or buffer.numel() < waveform.numel():
+            buffer = _pinned_out.buffer = torch.empty(waveform.numel(), dtype=torch.float32, pin_memory=True)
+        out = buffer[:waveform.numel()]
+        out.copy_(waveform, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+    return out.numpy()
+
+def get_prompt_embeds(prompt):
+    """Return cached AudioLDM2 text-encoder outputs for a prompt as pipeline keyword arguments."""
+
+    with _prompt_embed_lock:
+        embeds = _prompt_embed_cache.get(prompt)
+        if embeds is not None:
+            _prompt_embed_cache.move_to_end(prompt)
+            return embeds
+
+    def encode(prompt):
+        with torch.inference_mode():
+            return audioldm2_model.encode_prompt(
+                prompt,
+                device,
+                num_waveforms_per_prompt=1,
+                do_classifier_free_guidance=True
+            )
+
+    # The text encoders (CLAP, T5, GPT-2) are the likeliest place for MPS float16 to fail
+    with _gpu_lock:
+        prompt_embeds, attention_mask, generated_prompt_embeds = _call_with_fp32_fallback(encode, prompt)
+
+    # With classifier-free guidance each output is [negative, positive] along the batch axis
+    negative_prompt_embeds, prompt_embeds = prompt_embeds.chunk(2)
+    negative_attention_mask, attention_mask = attention_mask.chunk(2)
+    negative_generated_prompt_embeds, generated_prompt_embeds = generated_prompt_embeds.chunk(2)
+    embeds = {
+        "prompt_embeds": prompt_embeds,
+        "negative_prompt_embeds": negative_prompt_embeds,
+        "attention_mask": attention_mask,
+        "negative_attention_mask": negative_attention_mask,
+        "generated_prompt_embeds": generated_prompt_embeds,
+        "negative_generated_prompt_embeds": negative_generated_prompt_embeds
+    }
+
+    with _prompt_embed_lock:
+        _prompt_embed_cache[prompt] = embeds
+        while len(_prompt_embed_cache) > PROMPT_EMBED_CACHE_SIZE:
+            _prompt_embed_cache.popitem(last=False)
+    return embeds
+
+def load_key_from_unity_storage():
+    """Read the ElevenLabs API key from Unity's API key storage, if it is B64 encoded."""
+    if UNITY_KEY_PATH is None or not os.path.exists(UNITY_KEY_PATH):
+        return None
+    try:
+        with open(UNITY_KEY_PATH, 'r') as f:
+            data = json.load(f)
+            for key_config in data.get('keys', []):
+                if key_config.get('provider') == 1:  # ElevenLabs enum value
+                    encrypted_key = key_config.get('key', '')
+                    # Try to decode if it's base64 encoded (simple fallback)
+                    if encrypted_key.startswith('B64:'):
+                        logger.info("Found ElevenLabs API key from Unity storage")
+                        return base64.b64decode(encrypted_key[4:]).decode('utf-8')
+                    break
+    except Exception as e:
+        logger.warning(f"Failed to read Unity API keys: {e}")
+    return None
+
+def load_key_from_env_file():
+    """Read the ElevenLabs API key from a local .env file."""
+    try:
+        with open('.env', 'r') as f:
+            for line in f:
+                if line.startswith('ELEVENLABS_API_KEY='):
+                    return line.strip().split('=', 1)[1].strip('"\'')
+    except OSError:
+        pass
+    return None
+
+@functools.lru_cache(maxsize=1)
+def resolve_elevenlabs_key():
+    """Resolve the ElevenLabs API key from the environment, Unity storage or .env, in that order.
+
+    Looked up once on first use; POST /reload_keys clears the cache to pick up keys added later.
+    """
+    return os.environ.get('ELEVENLABS_API_KEY') or load_key_from_unity_storage() or load_key_from_env_file()
+
+@functools.lru_cache(maxsize=1)
+def get_elevenlabs_client(api_key):
+    """Return a shared ElevenLabs client so concurrent requests reuse its pooled HTTPS connections."""
+    return ElevenLabs(api_key=api_key)
+
+@app.route('/reload_keys', methods=['POST'])
+def reload_keys():
+    """Re-read the ElevenLabs API key without restarting the server."""
+    resolve_elevenlabs_key.cache_clear()
+    return jsonify({"elevenlabs": bool(resolve_elevenlabs_key())})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    # Check if ElevenLabs API key is available
-    elevenlabs_available = bool(os.environ.get('ELEVENLABS_API_KEY'))
-    if not elevenlabs_available:
-        # Try to check .env file
-        try:
-            with open('.env', 'r') as f:
-                for line in f:
-                    if line.startswith('ELEVENLABS_API_KEY='):
-                        elevenlabs_available = True
-                        break
-        except:
-            pass
-
     return jsonify({
         "status": "healthy",
         "providers": {
             "audioldm2": audioldm2_model is not None,
-            "elevenlabs": elevenlabs_available
+            "elevenlabs": bool(resolve_elevenlabs_key())
         },
         "device": str(device) if device else "not initialized"
     })
 
 def generate_with_elevenlabs(prompt, seed, sample_rate, duration_seconds, prompt_influence, looping=False):
     """Generate audio using ElevenLabs API."""
-    try:
-        from elevenlabs import generate, set_api_key, Voice, VoiceSettings
-        import json
-        import platform
-
-        # Get API key from environment variable
-        api_key = os.environ.get('ELEVENLABS_API_KEY')
-
-        # Try to read from Unity's API key storage
-        if not api_key:
-            unity_key_paths = []
-            if platform.system() == 'Darwin':  # macOS
-                unity_key_paths.append(os.path.expanduser('~/Library/Application Support/DefaultCompany/SatieLang/satie_api_keys.json'))
-            elif platform.system() == 'Windows':
-                unity_key_paths.append(os.path.expanduser('~/AppData/LocalLow/DefaultCompany/SatieLang/satie_api_keys.json'))
-            elif platform.system() == 'Linux':
-                unity_key_paths.append(os.path.expanduser('~/.config/unity3d/DefaultCompany/SatieLang/satie_api_keys.json'))
-
-            for key_path in unity_key_paths:
-                if os.path.exists(key_path):
-                    try:
-                        with open(key_path, 'r') as f:
-                            data = json.load(f)
-                            for key_config in data.get('keys', []):
-                                if key_config.get('provider') == 1:  # ElevenLabs enum value
-                                    encrypted_key = key_config.get('key', '')
-                                    # Try to decode if it's base64 encoded (simple fallback)
-                                    if encrypted_key.startswith('B64:'):
-                                        import base64
-                                        api_key = base64.b64decode(encrypted_key[4:]).decode('utf-8')
-                                        logger.info("Found ElevenLabs API key from Unity storage")
-                                    break
-                    except Exception as e:
-                        logger.warning(f"Failed to read Unity API keys: {e}")
+    if ElevenLabs is None:
+        raise Exception("elevenlabs package not installed. Run: pip install elevenlabs")
 
-        if not api_key:
-            # Try to read from a local .env file as fallback
-            try:
-                with open('.env', 'r') as f:
-                    for line in f:
-                        if line.startswith('ELEVENLABS_API_KEY='):
-                            api_key = line.strip().split('=', 1)[1].strip('"\'')
-                            break
-            except:
-                pass
+    try:
+        # Cached after the first lookup, no disk access per request
+        api_key = resolve_elevenlabs_key()
 
         if not api_key:
             raise Exception("ELEVENLABS_API_KEY not found. Please set it in Unity's API Key Manager (Window > Satie > API Key Manager)")
 
-        set_api_key(api_key)
-
         logger.info(f"Generating audio with ElevenLabs: '{prompt}'")
 
         # Generate sound effect using ElevenLabs sound generation
-        from elevenlabs.client import ElevenLabs
-        client = ElevenLabs(api_key=api_key)
+        client = get_elevenlabs_client(api_key)
 
         # Generate sound effect
         result = client.text_to_sound_effects.convert(
@@ -151,41 +422,33 @@ def generate_with_elevenlabs(prompt, seed, sample_rate, duration_seconds, prompt
             prompt_influence=prompt_influence
         )
 
-        # The result is an iterator of audio chunks
-        audio_chunks = []
+        # The result is an iterator of audio chunks; write them straight into one buffer
+        audio_buffer = io.BytesIO()
         for chunk in result:
-            audio_chunks.append(chunk)
-
-        # Combine chunks into a single audio buffer
-        audio_bytes = b''.join(audio_chunks)
+            audio_buffer.write(chunk)
+        audio_buffer.seek(0)
 
-        # Convert bytes to audio array
-        audio_buffer = io.BytesIO(audio_bytes)
-        audio_data, orig_sr = sf.read(audio_buffer)
+        # Decode as float32 rather than soundfile's default float64
+        audio_data, orig_sr = sf.read(audio_buffer, dtype='float32')
 
         # Resample if needed
         if orig_sr != sample_rate:
-            import librosa
-            audio_data = librosa.resample(
-                audio_data,
-                orig_sr=orig_sr,
-                target_sr=sample_rate
-            )
+            audio_data = soxr.resample(audio_data, orig_sr, sample_rate, quality="HQ")
 
         # Apply looping if requested
         if looping:
             # Simple crossfade for looping
             fade_duration = int(0.1 * sample_rate)  # 100ms fade
             if len(audio_data) > fade_duration * 2:
-                # Create fade out at end
-                audio_data[-fade_duration:] *= np.linspace(1, 0, fade_duration)
-                # Create fade in at start
-                audio_data[:fade_duration] *= np.linspace(0, 1, fade_duration)
+                fade_in, fade_out = get_fades(fade_duration)
+                if audio_data.ndim > 1:
+                    fade_in, fade_out = fade_in[:, None], fade_out[:, None]
+                # Fade out at end, fade in at start (in place)
+                audio_data[-fade_duration:] *= fade_out
+                audio_data[:fade_duration] *= fade_in
 
         return audio_data
 
-    except ImportError:
-        raise Exception("elevenlabs package not installed. Run: pip install elevenlabs")
     except Exception as e:
         logger.error(f"ElevenLabs generation error: {str(e)}")
         raise
@@ -197,14 +460,16 @@ def generate_audio():
 
     try:
         # Parse request data
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
         prompt = data.get('prompt', '')
         seed = data.get('seed', 0)
         sample_rate = data.get('sample_rate', 44100)
-        provider = data.get('provider', 'elevenlabs').lower()
+        provider = data.get('provider', 'elevenlabs')
 
         # Provider-specific parameters
-        num_inference_steps = data.get('num_inference_steps', 200)
+        num_inference_steps = data.get('num_inference_steps', DEFAULT_INFERENCE_STEPS)
         audio_length_in_s = data.get('audio_length_in_s', 10.0)
         duration_seconds = data.get('duration_seconds', 10.0)
         prompt_influence = data.get('prompt_influence', 0.3)
@@ -213,83 +478,88 @@ def generate_audio():
         if not prompt:
             return jsonify({"error": "No prompt provided"}), 400
 
+        # Reject bad input before any model or network work
+        provider = provider.lower() if isinstance(provider, str) else provider
+        if provider not in VALID_PROVIDERS:
+            return jsonify({"error": f"Unknown provider: {provider}"}), 400
+        error = validate_generation_params(seed, sample_rate, num_inference_steps, audio_length_in_s)
+        if error is None and not (_is_number(duration_seconds) and 0.5 <= duration_seconds <= 30):
+            error = "duration_seconds must be in [0.5, 30]"
+        if error is None and not (_is_number(prompt_influence) and 0 <= prompt_influence <= 1):
+            error = "prompt_influence must be in [0, 1]"
+        if error:
+            return jsonify({"error": error}), 400
+
         logger.info(f"Generating audio for prompt: '{prompt}' with provider: {provider}, seed: {seed}")
 
         # Generate audio based on provider
         if provider == 'audioldm2':
-            if audioldm2_model is None:
+            if not ensure_audioldm2():
                 return jsonify({"error": "AudioLDM2 model not initialized"}), 503
 
-            import torch
             # Set seed for reproducibility
             generator = torch.Generator(device=device).manual_seed(seed)
 
             # Generate audio with error handling for different model versions
-            with torch.no_grad():
-                try:
-                    output = audioldm2_model(
-                        prompt,
-                        num_inference_steps=num_inference_steps,
-                        audio_length_in_s=audio_length_in_s,
-                        generator=generator
-                    )
-                except AttributeError as e:
-                    if '_get_initial_cache_position' in str(e):
-                        # Try without some parameters for compatibility
-                        logger.warning("Compatibility issue detected, trying simplified generation")
-                        output = audioldm2_model(prompt, generator=generator)
-                    else:
-                        raise e
-
-            # Get the audio array
-            audio_array = output.audios[0]
-
-            # Ensure audio is in the correct shape
-            if audio_array.ndim == 1:
-                audio_data = audio_array
+            try:
+                # On CUDA stop at the latents so the waveform is decoded straight into pinned memory
+                output = run_audioldm2(
+                    num_inference_steps=num_inference_steps,
+                    audio_length_in_s=audio_length_in_s,
+                    generator=generator,
+                    output_type="latent" if device.type == "cuda" else "np",
+                    **get_prompt_embeds(prompt)
+                )
+            except AttributeError as e:
+                if '_get_initial_cache_position' in str(e):
+                    # Try without some parameters for compatibility
+                    logger.warning("Compatibility issue detected, trying simplified generation")
+                    output = run_audioldm2(prompt, generator=generator)
+                else:
+                    raise e
+
+            if torch.is_tensor(output.audios):
+                audio_data = decode_audioldm2_latents(output.audios, audio_length_in_s)
             else:
-                audio_data = audio_array.squeeze()
+                # Get the audio array
+                audio_array = output.audios[0]
 
-            # Normalize audio to prevent clipping
-            max_val = np.abs(audio_data).max()
-            if max_val > 0:
-                audio_data = audio_data / max_val * 0.95
+                # Ensure audio is in the correct shape
+                if audio_array.ndim == 1:
+                    audio_data = audio_array
+                else:
+                    audio_data = audio_array.squeeze()
 
             # Convert to the requested sample rate if needed
             if sample_rate != 16000:
                 # AudioLDM2 generates at 16kHz by default
                 # Resample if different rate is requested
-                import librosa
-                audio_data = librosa.resample(
-                    audio_data,
-                    orig_sr=16000,
-                    target_sr=sample_rate
-                )
+                audio_data = soxr.resample(audio_data, 16000, sample_rate, quality="HQ")
         elif provider == 'elevenlabs':
             audio_data = generate_with_elevenlabs(prompt, seed, sample_rate, duration_seconds, prompt_influence, looping)
         elif provider == 'test':
             # Generate a simple test tone
             duration = 2.0
-            t = np.linspace(0, duration, int(sample_rate * duration))
             frequency = 440 + seed * 10  # A4 with slight variation based on seed
-            audio_data = 0.5 * np.sin(2 * np.pi * frequency * t)
+            phases = np.arange(int(sample_rate * duration)) * (frequency * SINE_LUT_SIZE / sample_rate)
+            audio_data = 0.5 * SINE_LUT[phases.astype(np.int64) & (SINE_LUT_SIZE - 1)]
             logger.info(f"Generated test tone at {frequency}Hz")
         else:
             return jsonify({"error": f"Unknown provider: {provider}"}), 400
 
-        # Create WAV file in memory
-        wav_buffer = io.BytesIO()
-        sf.write(wav_buffer, audio_data, sample_rate, format='WAV')
-        wav_buffer.seek(0)
+        # Normalize (only when it would clip) and convert to int16 in one pass
+        pcm = normalize_and_quantize(audio_data)
 
         logger.info(f"Audio generated successfully using {provider}")
 
-        # Return the WAV file
-        return send_file(
-            wav_buffer,
+        # Stream the WAV file block by block instead of buffering the whole file
+        return Response(
+            iter_wav_chunks(pcm, sample_rate),
             mimetype='audio/wav',
-            as_attachment=True,
-            download_name=f'generated_{provider}_{seed}.wav'
+            headers={
+                'Content-Disposition': f'attachment; filename=generated_{provider}_{seed}.wav',
+                'Content-Length': str(44 + pcm.nbytes)
+            }
         )
 
     except Exception as e:
@@ -299,68 +569,63 @@ def generate_audio():
 @app.route('/generate_multiple', methods=['POST'])
 def generate_multiple_audio():
     """Generate multiple audio variations from a single prompt."""
-    global model
-
-    if model is None:
-        return jsonify({"error": "Model not initialized"}), 503
+    global audioldm2_model
 
     try:
         # Parse request data
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
         prompt = data.get('prompt', '')
         num_options = data.get('num_options', 3)
         sample_rate = data.get('sample_rate', 16000)
-        num_inference_steps = data.get('num_inference_steps', 200)
+        num_inference_steps = data.get('num_inference_steps', DEFAULT_INFERENCE_STEPS)
         audio_length_in_s = data.get('audio_length_in_s', 10.0)
 
         if not prompt:
             return jsonify({"error": "No prompt provided"}), 400
 
+        # Reject bad input before loading or running the model
+        error = validate_generation_params(0, sample_rate, num_inference_steps, audio_length_in_s)
+        if error is None and not (_is_int(num_options) and 1 <= num_options <= MAX_NUM_OPTIONS):
+            error = f"num_options must be an integer in [1, {MAX_NUM_OPTIONS}]"
+        if error:
+            return jsonify({"error": error}), 400
+
+        if not ensure_audioldm2():
+            return jsonify({"error": "Model not initialized"}), 503
+
         logger.info(f"Generating {num_options} audio options for prompt: '{prompt}'")
 
         audio_files = []
 
-        for i in range(num_options):
-            # Use different seed for each variation
-            seed = i
-            generator = torch.Generator(device=device).manual_seed(seed)
-
-            # Generate audio
-            with torch.no_grad():
-                output = model(
-                    prompt,
-                    num_inference_steps=num_inference_steps,
-                    audio_length_in_s=audio_length_in_s,
-                    generator=generator
-                )
+        # The prompt is the same for every option: encode it once and repeat it across the batch
+        prompt_embeds = {
+            name: embeds.repeat_interleave(num_options, dim=0)
+            for name, embeds in get_prompt_embeds(prompt).items()
+        }
 
-            # Get the audio array
-            audio_array = output.audios[0]
+        # One generator per option, seeded by its index, so all options run in a single batched call
+        generator = [torch.Generator(device=device).manual_seed(i) for i in range(num_options)]
 
-            # Ensure audio is in the correct shape
-            if audio_array.ndim == 1:
-                audio_data = audio_array
-            else:
-                audio_data = audio_array.squeeze()
+        output = run_audioldm2(
+            num_inference_steps=num_inference_steps,
+            audio_length_in_s=audio_length_in_s,
+            generator=generator,
+            num_waveforms_per_prompt=1,
+            **prompt_embeds
+        )
 
-            # Normalize audio
-            max_val = np.abs(audio_data).max()
-            if max_val > 0:
-                audio_data = audio_data / max_val * 0.95
+        for i, audio_array in enumerate(output.audios):
+            audio_data = audio_array.reshape(-1)
 
             # Resample if needed
             if sample_rate != 16000:
-                import librosa
-                audio_data = librosa.resample(
-                    audio_data,
-                    orig_sr=16000,
-                    target_sr=sample_rate
-                )
+                audio_data = soxr.resample(audio_data, 16000, sample_rate, quality="HQ")
 
-            # Convert to WAV bytes
-            wav_buffer = io.BytesIO()
-            sf.write(wav_buffer, audio_data, sample_rate, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+            # Normalize (only when it would clip), convert to int16 and prepend the WAV header
+            pcm = normalize_and_quantize(audio_data)
+            wav_bytes = wav_header(len(pcm), sample_rate) + pcm.tobytes()
 
             # Encode as base64 for JSON response
             audio_base64 = base64.b64encode(wav_bytes).decode('utf-8')
@@ -390,7 +655,8 @@ def index():
         "endpoints": {
             "/health": "Health check",
             "/generate": "Generate audio from prompt",
-            "/generate_multiple": "Generate multiple audio variations"
+            "/generate_multiple": "Generate multiple audio variations",
+            "/reload_keys": "Re-read the ElevenLabs API key (POST)"
         },
         "setup": {
             "elevenlabs": "Set ELEVENLABS_API_KEY environment variable or add to .env file",
@@ -400,13 +666,12 @@ def index():
 
 if __name__ == '__main__':
     # Try to initialize AudioLDM2 if available (optional)
-    try:
-        initialize_audioldm2()
-    except:
+    if not ensure_audioldm2():
         logger.info("AudioLDM2 initialization skipped (will initialize on demand)")
 
     # Run the server
     port = int(os.environ.get('PORT', 5001))
     logger.info(f"Starting server on port {port}")
     logger.info("For ElevenLabs support, set ELEVENLABS_API_KEY environment variable")
+    logger.info("For concurrent clients run: gunicorn -c gunicorn_conf.py audioldm2_server:app")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
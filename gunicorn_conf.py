@@ -0,0 +1,22 @@
+"""
+Gunicorn configuration for the SatieLang audio generation servers
+
+Usage: gunicorn -c gunicorn_conf.py audio_generation_server:app
+       gunicorn -c gunicorn_conf.py audioldm2_server:app
+
+gunicorn does not run on Windows; use waitress there instead:
+       waitress-serve --threads=8 --port=5001 audioldm2_server:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+
+# A single process keeps exactly one AudioLDM2 pipeline in GPU memory;
+# threads let ElevenLabs I/O, MP3 decoding and queued AudioLDM2 requests overlap
+workers = 1
+worker_class = "gthread"
+threads = 16
+
+# AudioLDM2 generation (and the first-request model load) can take minutes
+timeout = 300
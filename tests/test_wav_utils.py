@@ -0,0 +1,55 @@
+import io
+import wave
+
+import numpy as np
+
+from wav_utils import normalize_and_quantize, wav_header, write_wav_pcm16
+
+def read_wav(data):
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        params = wav.getparams()
+        samples = np.frombuffer(wav.readframes(params.nframes), dtype='<i2')
+    return params, samples
+
+def test_write_wav_pcm16_round_trip():
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-1.0, 1.0, 44100).astype(np.float32)
+
+    params, samples = read_wav(write_wav_pcm16(audio, 44100))
+
+    assert (params.nchannels, params.sampwidth, params.framerate, params.nframes) == (1, 2, 44100, len(audio))
+    # Rounding (not truncation) keeps every sample within half an LSB
+    assert np.max(np.abs(samples / 32767.0 - audio)) <= 0.5 / 32767.0 + 1e-7
+
+def test_write_wav_pcm16_stereo_header():
+    audio = np.zeros((100, 2), dtype=np.float32)
+
+    params, samples = read_wav(write_wav_pcm16(audio, 48000))
+
+    assert (params.nchannels, params.framerate, params.nframes) == (2, 48000, 100)
+    assert samples.size == 200
+
+def test_write_wav_pcm16_clips_out_of_range():
+    audio = np.array([2.0, -2.0, 1.0, -1.0], dtype=np.float32)
+
+    _, samples = read_wav(write_wav_pcm16(audio, 16000))
+
+    assert samples.tolist() == [32767, -32768, 32767, -32767]
+
+def test_normalize_and_quantize_round_trip():
+    t = np.arange(16000, dtype=np.float32) / 16000
+    audio = 0.5 * np.sin(2 * np.pi * 440 * t)
+
+    pcm = normalize_and_quantize(audio)
+    params, samples = read_wav(wav_header(len(pcm), 16000) + pcm.tobytes())
+
+    assert (params.nchannels, params.sampwidth, params.framerate, params.nframes) == (1, 2, 16000, len(audio))
+    # Below the 0.95 peak nothing is rescaled, so only rounding error remains
+    assert np.max(np.abs(samples / 32767.0 - audio)) <= 0.5 / 32767.0 + 1e-7
+
+def test_normalize_and_quantize_limits_peak():
+    audio = np.array([0.0, 2.0, -1.0], dtype=np.float32)
+
+    pcm = normalize_and_quantize(audio)
+
+    assert pcm.tolist() == [0, round(0.95 * 32767), round(-0.475 * 32767)]
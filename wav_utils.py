@@ -0,0 +1,42 @@
+"""
+16-bit PCM WAV encoding shared by the SatieLang audio generation servers
+"""
+
+import struct
+
+import numpy as np
+
+def wav_header(num_frames: int, sample_rate: int, channels: int = 1) -> bytes:
+    """Build the 44-byte RIFF header for 16-bit PCM audio."""
+    block_align = channels * 2
+    data_size = num_frames * block_align
+    return (
+        b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, 16)
+        + b'data' + struct.pack('<I', data_size)
+    )
+
+def float_to_pcm16(audio: np.ndarray) -> np.ndarray:
+    """Convert a float waveform in [-1, 1] to little-endian int16, rounding to the nearest step like libsndfile."""
+    scaled = np.multiply(audio, 32767.0, dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype('<i2')
+
+def write_wav_pcm16(audio: np.ndarray, sample_rate: int) -> bytes:
+    """Encode a float waveform of shape (frames,) or (frames, channels) as a 16-bit PCM WAV file."""
+    channels = 1 if audio.ndim == 1 else audio.shape[1]
+    return wav_header(len(audio), sample_rate, channels) + float_to_pcm16(audio).tobytes()
+
+def normalize_and_quantize(audio: np.ndarray, peak: float = 0.95) -> np.ndarray:
+    """Scale a float waveform down to `peak` if it would clip and convert it to 16-bit PCM.
+
+    The peak comes from two reductions (max and min) that need no temporary array;
+    scale, rounding, clip and int16 cast share one float32 buffer.
+    """
+    max_val = max(float(audio.max()), -float(audio.min())) if audio.size else 0.0
+    scale = 32767.0 * (peak / max_val if max_val > peak else 1.0)
+    scaled = np.multiply(audio, scale, dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype('<i2')